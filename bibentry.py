@@ -12,15 +12,34 @@ __version__ = "1.0"
 
 ##################################################
 
-import collections, re
+import re
 
 ##################################################
 
-# Citation identifier types
-arxivRE = re.compile(r'^\d{4}.\d{4,5}$')
-arxiv_oldRE = re.compile(r'^[a-z.\-]+/[09]\d{6}$', re.IGNORECASE)
-inspireRE = re.compile(r'^[a-zA-Z\-]+:\d{4}[a-z]{2,3}$')
-doiRE = re.compile(r'^10.[0-9.]{4,}/\w+')
+# Citation identifier types (name of matching group)
+idRE = re.compile(r'^(?:(?P<arxiv>\d{4}.\d{4,5})$'
+                  r'|(?P<arxiv_old>(?i:[a-z.\-]+)/[09]\d{6})$'
+                  r'|(?P<inspire>[a-zA-Z\-]+:\d{4}[a-z]{2,3})$'
+                  r'|(?P<doi>10.[0-9.]{4,}/\w+))')
+
+# BibTeX structure
+tagRE = re.compile(r'@\w+\{([^,\r\n]*)')
+fieldRE = re.compile(r'[ \t]*([^=\s]+)[ \t]*=[ \t]*(.*)')
+endRE = re.compile(r'^}', re.MULTILINE)
+
+##################################################
+
+def IDType(ref):
+    """Return type of citation identifier ('arxiv', 'inspire' or 'doi'),
+    or None if not recognised."""
+
+    match = idRE.match(ref)
+    if match is None:
+        return None
+    elif match.lastgroup == 'arxiv_old':
+        return 'arxiv'
+    else:
+        return match.lastgroup
 
 ##################################################
 
@@ -32,15 +51,62 @@ class BibEntry:
     def __init__(self, bibtex=None):
         """Initialise class instance and optionally store bibtex information."""
     
-        self.IDs = {'arxiv': None, 'inspire': None, 'doi': None}
+        self._IDs = {'arxiv': None, 'inspire': None, 'doi': None}
         self.tag = None
-        self.info = collections.OrderedDict()
+        self._info = {}
+
+        # BibTeX string waiting to be parsed
+        self._bibtex = None
 
         if bibtex is not None:
             self.ReadBibTeX(bibtex)
 
     ##############################
 
+    @classmethod
+    def Lazy(cls, bibtex):
+        """Create instance storing only the tag. The remaining bibtex
+        information is parsed the first time it is needed."""
+
+        tag = tagRE.match(bibtex.lstrip())
+        if tag is None:
+            raise ValueError("Invalid BibTeX string!")
+
+        bib = cls()
+        bib.tag = tag.group(1)
+        bib._bibtex = bibtex
+
+        return bib
+
+    ##############################
+
+    @property
+    def IDs(self):
+        self._Parse()
+        return self._IDs
+
+    ##############################
+
+    @property
+    def info(self):
+        self._Parse()
+        return self._info
+
+    ##############################
+
+    def _Parse(self):
+        """Parse stored bibtex string, if any, keeping the current tag."""
+
+        if self._bibtex is not None:
+            bibtex = self._bibtex
+            tag = self.tag
+
+            self._bibtex = None
+            self.ReadBibTeX(bibtex)
+            self.tag = tag
+
+    ##############################
+
     def __repr__(self):
         return 'bibentry.BibEntry({})'.format(self.BibTeXString())
 
@@ -54,72 +120,100 @@ class BibEntry:
     def ReadBibTeX(self, bibtex):
         """Parse BibTeX string and store information."""
 
-        sissa = False
         bibtex = bibtex.strip()
 
-        if not bibtex.startswith('@'):
+        # Get tag
+        tag = tagRE.match(bibtex)
+        if tag is None:
             raise ValueError("Invalid BibTeX string!")
+        self.tag = tag.group(1)
 
-        try:
-            for line in bibtex.splitlines():
+        # Check if it's a valid Inspire identifier
+        if IDType(self.tag) == 'inspire':
+            self._IDs['inspire'] = self.tag
 
-                # Get tag
-                if line.startswith('@'):
-                    self.tag = line.split('{')[1].split(',')[0]
+        # Parse data fields from the line after the tag up to the end of the entry
+        start = bibtex.find('\n', tag.end())
+        start = start if start != -1 else len(bibtex)
+        end = endRE.search(bibtex, start)
+        end = end.start() if end is not None else len(bibtex)
 
-                    # Check if it's a valid Inspire identifier
-                    if inspireRE.match(self.tag) is not None:
-                        self.IDs['inspire'] = self.tag
+        fields = []
+        for line in bibtex[start:end].splitlines():
 
-                # End of entry
-                elif line.startswith('}'):
-                    break
+            # Continuation of a multi-line field
+            if fields and not self._Complete(fields[-1][1]):
+                fields[-1][1] += '\n' + line
+                continue
 
-                # Parse data fields
-                else:
-                    s = line.split('=')
-                    field = s[0].strip().lower()
-                    data = s[1].strip()
-                    if data.endswith(','):
-                        data = data[:-1]
+            match = fieldRE.match(line)
+            if match is not None:
+                fields.append([match.group(1).lower(), match.group(2)])
+            elif line.strip(' \t\r,'):
+                raise ValueError("Invalid BibTeX string!")
 
-                    self.info[field] = data
+        for field, data in fields:
+            data = data.rstrip(' \t\r')
+            if data.endswith(','):
+                data = data[:-1].rstrip(' \t')
 
-                    # Get arXiv identifier
-                    if field == 'eprint':
-                        arxiv_id = data[1:-1]
-                        if arxivRE.match(arxiv_id) is not None or arxiv_oldRE.match(arxiv_id) is not None:
-                            self.IDs['arxiv'] = arxiv_id
+            self._info[field] = data
 
-                    # Get DOI
-                    elif field == 'doi':
-                        doi = data[1:-1]
-                        if doiRE.match(doi) is not None:
-                            self.IDs['doi'] = doi
+            # Get arXiv identifier or DOI
+            readID = self._readID.get(field)
+            if readID is not None:
+                readID(self, data)
 
-                    # Check if SISSA journal (JCAP/JHEP)
-                    elif field == 'journal' and (data == '"JCAP"' or data == '"JHEP"'):
-                        sissa = True
+        # Add 'number' field for JCAP and JHEP
+        if self._info.get('journal') in ('"JCAP"', '"JHEP"'):
+            self._info['number'] = self._info['year']
 
-            # Add 'number' field for JCAP and JHEP
-            if sissa:
-                self.info['number'] = self.info['year']
+    ##############################
 
-        except (IndexError, ValueError):
-            raise ValueError("Invalid BibTeX string!")
+    @staticmethod
+    def _Complete(data):
+        """Check if all braces and quotes in field data have been closed."""
+
+        data = data.rstrip(' \t\r,')
+        if data.count('{') != data.count('}'):
+            return False
+
+        return not data.startswith('"') or (len(data) > 1 and data.endswith('"'))
+
+    ##############################
+
+    def _ReadArXivID(self, data):
+        """Store arXiv identifier from eprint field."""
+
+        arxiv_id = data[1:-1]
+        if IDType(arxiv_id) == 'arxiv':
+            self._IDs['arxiv'] = arxiv_id
+
+    ##############################
+
+    def _ReadDOI(self, data):
+        """Store DOI from doi field."""
+
+        doi = data[1:-1]
+        if IDType(doi) == 'doi':
+            self._IDs['doi'] = doi
+
+    # Fields containing citation identifiers
+    _readID = {'eprint': _ReadArXivID, 'doi': _ReadDOI}
 
     ##############################
 
     def BibTeXString(self):
         """Return BibTeX data as a string."""
 
-        bibtex = '@article{{{},\n'.format(self.tag)
+        parts = ['@article{', self.tag, ',\n']
 
         for field, data in self.info.items():
-            bibtex += '\t{} = {},\n'.format(field, data)
+            parts += ['\t', field, ' = ', data, ',\n']
 
-        bibtex = bibtex[:-2] + '\n}\n'
+        # Replace trailing comma with closing brace
+        parts[-1] = '\n}\n'
 
-        return bibtex
+        return ''.join(parts)
 
 ##################################################
\ No newline at end of file
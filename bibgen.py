@@ -27,103 +27,334 @@ __version__ = "3.0"
 
 ##################################################
 
-import argparse, collections, os.path, sys, urllib.request
+import argparse, concurrent.futures, http.client, os.path, queue, re, shutil, sqlite3, sys, tempfile, time, urllib.parse
 
 import bibentry
 
 ##################################################
 
-def GetInspireBibTeX(ref):
+# Inspire API connection settings
+INSPIRE_HOST = 'inspirehep.net'
+TIMEOUT = 10
+MAX_RETRIES = 3
+MAX_REDIRECTS = 5
+BACKOFF_FACTOR = 0.3
+MAX_WORKERS = 5
+BATCH_SIZE = 100
+
+# Inspire API path for each identifier type
+apiPaths = {'arxiv': '/api/arxiv/{}?format=bibtex',
+            'inspire': '/api/literature?q=texkey:{}&format=bibtex',
+            'doi': '/api/doi/{}?format=bibtex'}
+
+# Inspire search query for each identifier type
+searchTerms = {'arxiv': 'arxiv:{}', 'inspire': 'texkey:{}', 'doi': 'doi:"{}"'}
+
+# Cache of downloaded BibTeX
+CACHE_FILE = os.path.expanduser('~/.cache/bibgen.sqlite')
+CACHE_TTL = 30*86400
+
+# Idle HTTPS connections to Inspire, shared between download threads
+_connections = queue.LifoQueue()
+
+# \cite command
+citeRE = re.compile(rb'\\cite\{([^}]*)\}')
+
+# Start of bibtex entry
+entryRE = re.compile(r'^(?=@)', re.MULTILINE)
+
+# Tag of bibtex entry in .bib file
+bibTagRE = re.compile(rb'^@\w+\{([^,\r\n]*)', re.MULTILINE)
+
+##################################################
+
+def InspireRequest(path, redirects=MAX_REDIRECTS):
+    """Send GET request to Inspire API and return the response body.
+    Connections are kept alive and reused by all threads. Requests are
+    retried if the connection fails or Inspire's rate limit is exceeded,
+    and redirects to other Inspire pages are followed.
+    Returns None if the server responds with an error.
+    """
+
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(delay)
+        delay = BACKOFF_FACTOR * 2**attempt
+
+        try:
+            conn = _connections.get_nowait()
+        except queue.Empty:
+            conn = http.client.HTTPSConnection(INSPIRE_HOST, timeout=TIMEOUT)
+
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # Connection closed by server or network error, reconnect and retry
+            conn.close()
+            if attempt == MAX_RETRIES:
+                raise
+            continue
+
+        # Return connection to pool for reuse
+        _connections.put(conn)
+
+        # Too many requests, wait as long as the server asks before retrying
+        if response.status == 429 and attempt < MAX_RETRIES:
+            retry_after = response.getheader('Retry-After', '')
+            if retry_after.isdigit():
+                delay = int(retry_after)
+            continue
+
+        # Follow redirect if it stays on Inspire
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            url = urllib.parse.urljoin('https://' + INSPIRE_HOST + path, response.getheader('Location', ''))
+            location = urllib.parse.urlsplit(url)
+            if location.netloc != INSPIRE_HOST:
+                return None
+            path = urllib.parse.urlunsplit(('', '', location.path, location.query, ''))
+            return InspireRequest(path, redirects - 1)
+
+        if response.status != 200:
+            return None
+
+        return data
+
+##################################################
+
+def GetInspireBibTeX(ref, identifier=None):
     """Download BibTeX information using Inspire API.
     Works with arXiv identifier, Inspire TeXkey, or DOI.
+    The identifier type is determined from ref if not given.
     """
 
     # Determine citation type
-    if bibentry.arxivRE.match(ref) is not None or bibentry.arxiv_oldRE.match(ref) is not None:
-        identifier = 'arxiv'
-    elif bibentry.inspireRE.match(ref) is not None:
-        identifier = 'texkey'
-    elif bibentry.doiRE.match(ref) is not None:
-        identifier = 'doi'
-    else:
-        return None
+    if identifier is None:
+        identifier = bibentry.IDType(ref)
+        if identifier is None:
+            return None
 
     # Retrieve bibtex data using Inspire API
     try:
-        if identifier == 'texkey':
-            bibtex = urllib.request.urlopen('https://inspirehep.net/api/literature?q=texkey:{}&format=bibtex'.format(ref)).read()
-        else:
-            bibtex = urllib.request.urlopen('https://inspirehep.net/api/{}/{}?format=bibtex'.format(identifier,ref)).read()
-    except urllib.error.HTTPError:
+        bibtex = InspireRequest(apiPaths[identifier].format(ref))
+    except (http.client.HTTPException, OSError):
+        return None
+
+    if bibtex is None:
         return None
 
     bibtex = bibtex.decode()
 
     # Check for valid bibtex
-    try:
-        bibtex.split('@',1)[1].rsplit('}\n',2)[0]
-    except IndexError:
+    if not bibtex.lstrip().startswith('@'):
         return None
-    
+
     return bibtex
 
 ##################################################
 
+def GetInspireBibTeXBatch(refs):
+    """Download BibTeX information for several references using a single
+    Inspire search. Works with arXiv identifiers, Inspire TeXkeys and DOIs.
+    Takes dictionary of references and their identifier types.
+    Returns dictionary of BibTeX strings for the references that were found.
+    """
+
+    # Search for all references at once
+    query = ' or '.join(searchTerms[identifier].format(ref) for ref, identifier in refs.items())
+    try:
+        bibtex = InspireRequest('/api/literature?q={}&size={}&format=bibtex'.format(urllib.parse.quote(query), BATCH_SIZE))
+    except (http.client.HTTPException, OSError):
+        return {}
+
+    if bibtex is None:
+        return {}
+
+    # Match returned entries to requested references (DOIs are case insensitive)
+    refs = {ref.lower(): ref for ref in refs}
+    found = {}
+    for entry in entryRE.split(bibtex.decode()):
+        if not entry.startswith('@'):
+            continue
+
+        for id in bibentry.BibEntry(entry).IDs.values():
+            if id is not None and id.lower() in refs:
+                found[refs[id.lower()]] = entry
+
+    return found
+
+##################################################
+
+def OpenCache():
+    """Open database of previously downloaded BibTeX.
+    Returns None if the cache can't be created.
+    """
+
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        cache = sqlite3.connect(CACHE_FILE)
+        cache.execute('CREATE TABLE IF NOT EXISTS bibtex(ref TEXT PRIMARY KEY, time INTEGER, bibtex TEXT)')
+    except (OSError, sqlite3.Error):
+        return None
+
+    return cache
+
+##################################################
+
+def CacheBibTeX(cache, bibtex):
+    """Store dictionary of downloaded BibTeX strings in the cache,
+    skipping references that were not found."""
+
+    if cache is None:
+        return
+
+    now = int(time.time())
+    cache.executemany('REPLACE INTO bibtex VALUES (?, ?, ?)', ((ref, now, data) for ref, data in bibtex.items() if data is not None))
+    cache.commit()
+
+##################################################
+
+def DownloadBibTeX(refs, verbose=False, jobs=MAX_WORKERS, refresh=False):
+    """Download BibTeX information for a dictionary of references and
+    their identifier types in parallel.
+    Recently downloaded references are read from the cache instead,
+    unless refresh is True.
+    Entries are parsed as they arrive, while other downloads are running.
+    Returns dictionary of BibEntry (None if not found on Inspire).
+    """
+
+    bibs = {}
+    cache = OpenCache()
+
+    # Use cached bibtex if it is recent enough
+    if cache is not None and not refresh:
+        for ref in refs:
+            row = cache.execute('SELECT time, bibtex FROM bibtex WHERE ref = ?', (ref,)).fetchone()
+            if row is not None and time.time() - row[0] < CACHE_TTL:
+                bibs[ref] = bibentry.BibEntry(row[1])
+                if verbose:
+                    print('\t{} (cached)'.format(ref))
+
+    # References with unrecognised identifiers can't be found on Inspire
+    for ref, identifier in refs.items():
+        if identifier is None:
+            bibs[ref] = None
+            if verbose:
+                print('\t{}'.format(ref))
+
+    download = {ref: identifier for ref, identifier in refs.items() if ref not in bibs}
+
+    # Results are cached as each request completes, so they are kept
+    # even if a later request fails
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+
+        # Search for references in batches
+        batch = list(download.items())
+        futures = [pool.submit(GetInspireBibTeXBatch, dict(batch[i:i+BATCH_SIZE])) for i in range(0, len(batch), BATCH_SIZE)]
+
+        for future in concurrent.futures.as_completed(futures):
+            found = future.result()
+            for ref, bibtex in found.items():
+                bibs[ref] = bibentry.BibEntry(bibtex)
+                if verbose:
+                    print('\t{}'.format(ref))
+
+            CacheBibTeX(cache, found)
+
+        # Download references missing from search results individually
+        futures = {pool.submit(GetInspireBibTeX, ref, identifier): ref for ref, identifier in download.items() if ref not in bibs}
+
+        for future in concurrent.futures.as_completed(futures):
+            ref = futures[future]
+            bibtex = future.result()
+            bibs[ref] = bibentry.BibEntry(bibtex) if bibtex is not None else None
+            if verbose:
+                print('\t{}'.format(ref))
+
+            CacheBibTeX(cache, {ref: bibtex})
+
+    if cache is not None:
+        cache.close()
+
+    return bibs
+
+##################################################
+
 def ReadBibTeX(bibfile):
     """Read bibtex data from .bib file and store as 
-    dictionary of BibEntry."""
+    dictionary of BibEntry. Entries are only parsed when used."""
     
-    refs = collections.OrderedDict()
+    refs = {}
     tag = None
 
-    with open(bibfile) as f:
+    with open(bibfile, 'rb') as f:
         for line in f:
 
-            if line.startswith('@'):
+            # Convert Windows newlines, as reading in text mode would
+            line = line.replace(b'\r\n', b'\n')
+
+            if line.startswith(b'@'):
                 if tag is not None:
-                    refs[tag] = bibentry.BibEntry(bibtex)
+                    refs[tag] = bibentry.BibEntry.Lazy(b''.join(bibtex).decode())
 
-                tag = line.split('{',1)[1].rsplit(',',1)[0]
-                bibtex = ''
+                # Tag is between opening brace and comma
+                start = line.index(b'{') + 1
+                end = line.find(b',', start)
+                tag = (line[start:end] if end != -1 else line[start:].rstrip()).decode()
+                bibtex = []
 
             if tag is not None:
-                bibtex += line
+                bibtex.append(line)
 
         if tag is not None:
-            refs[tag] = bibentry.BibEntry(bibtex)
+            refs[tag] = bibentry.BibEntry.Lazy(b''.join(bibtex).decode())
 
     return refs
 
 ##################################################
 
 def RefsFromBib(bibfile):
-    """Read references IDs from .bib file."""
+    """Read set of references IDs from .bib file."""
 
-    bibRefs = []
-    with open(bibfile) as f:
-        for line in f:
-            if line.startswith('@'):
-                bibRefs.append(line.split('{',1)[1].rsplit(',')[0])
+    with open(bibfile, 'rb') as f:
+        bib = f.read()
+
+    bibRefs = {tag.decode() for tag in bibTagRE.findall(bib)}
 
     return bibRefs
 
 ##################################################
 
-def RefsFromTeX(texfile):
-    """Read reference IDs from .tex file."""
+def ParseTeX(texfile):
+    """Read .tex file and find all \\cite commands.
+    Returns file contents, list of \\cite matches and file status
+    (modification time and size).
+    """
+
+    with open(texfile, 'rb') as f:
+        tex = f.read()
+        stat = os.fstat(f.fileno())
+
+    return tex, list(citeRE.finditer(tex)), (stat.st_mtime_ns, stat.st_size)
+
+##################################################
+
+def RefsFromTeX(tex, cites):
+    """Read reference IDs from \\cite commands found by ParseTeX,
+    ignoring comment lines."""
 
     texRefs = []
-    with open(texfile) as f:
-        for line in f:
-            if line.startswith('%'):
-                continue
-            for cite in line.split('\cite{')[1:]:
-                refs = cite.split('}', 1)[0].split(',')
+    for cite in cites:
+
+        # Skip \cite commands in comment lines
+        if tex.startswith(b'%', tex.rfind(b'\n', 0, cite.start()) + 1):
+            continue
 
-                for ref in refs:
-                    ref = ref.strip()
-                    if ref != '':
-                        texRefs.append(ref)
+        for ref in cite.group(1).split(b','):
+            ref = ref.strip()
+            if ref != b'':
+                texRefs.append(ref.decode())
 
     # Remove duplicates
     texRefs = list(dict.fromkeys(texRefs))
@@ -132,33 +363,56 @@ def RefsFromTeX(texfile):
 
 ##################################################
 
-def UpdateTeXCite(texfile, replacements):
-    """Replace \cite IDs according to dictionary of replacements."""
+def UpdateTeXCite(texfile, tex, cites, stat, replacements):
+    """Replace \\cite IDs according to dictionary of replacements.
+    Takes contents of texfile, \\cite commands and file status found by
+    ParseTeX. The file is read again if it has changed since then.
+    """
+
+    if len(replacements) == 0:
+        return
 
-    # Read texfile and update tex
-    newtex = []
-    with open(texfile) as f:
-        for line in f:
-            refs = []
-
-            # Get references in line
-            for cite in line.split('\cite{')[1:]:
-                refs += cite.split('}', 1)[0].split(',')
-
-            # Replace old identifier with new identifier
-            for ref in refs:
-                try:
-                    line = line.replace(ref,replacements[ref])
-                except KeyError:
-                    pass
-        
-            newtex.append(line)
+    # Don't overwrite changes made to texfile after it was parsed
+    current = os.stat(texfile)
+    if (current.st_mtime_ns, current.st_size) != stat:
+        tex, cites, stat = ParseTeX(texfile)
+
+    # Encode replacements to match binary file contents
+    replacements = {old.encode(): new.encode() for old, new in replacements.items()}
+
+    # Any old identifier, separated by commas or whitespace
+    replaceRE = re.compile(rb'(?<![^,\s])(?:' + b'|'.join(re.escape(ref) for ref in replacements) + rb')(?![^,\s])')
+
+    # Write updated tex to temporary file, replacing old identifiers with
+    # new identifiers inside each \cite and copying the rest unchanged
+    texfile = os.path.realpath(texfile)
+    tex = memoryview(tex)
+
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(texfile), delete=False)
+
+    try:
+        with f:
+            pos = 0
+            for cite in cites:
+                refs, n = replaceRE.subn(lambda ref: replacements[ref.group(0)], cite.group(1))
+
+                # Unchanged \cite is copied along with the surrounding text
+                if n == 0:
+                    continue
+
+                f.write(tex[pos:cite.start(1)])
+                f.write(refs)
+                pos = cite.end(1)
+            f.write(tex[pos:])
 
-    # Update texfile
-    with open(texfile, 'w') as f:
-        for line in newtex:
-            f.write(line)
-        pass
+        # Update texfile
+        shutil.copymode(texfile, f.name)
+        os.replace(f.name, texfile)
+
+    # Remove temporary file if texfile was not updated
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
 
 ##################################################
 
@@ -173,9 +427,12 @@ def main():
     parser.add_argument('-D', dest='doi', action='store_true', default=False, help='Replace all identifiers with DOI')
     parser.add_argument('-I', dest='inspire', action='store_true', default=False, help='Replace all identifiers with Inspire ID')
     parser.add_argument('-v', dest='verbose', action='store_true', default=False, help='Verbose')
+    parser.add_argument('-y', '--yes', dest='yes', action='store_true', default=False, help='Answer yes to all questions')
 
     parser.add_argument('--bibfile', dest='bibfile', default=None, help='Specify name of bib file')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=MAX_WORKERS, help='Number of parallel downloads (default: {})'.format(MAX_WORKERS))
     parser.add_argument('--overwrite', dest='overwrite', action='store_true', default=False, help='Overwrite bib file')
+    parser.add_argument('--refresh', dest='refresh', action='store_true', default=False, help='Ignore cached data and download all references again')
 
     args = parser.parse_args()
 
@@ -191,8 +448,12 @@ def main():
     else:
         bibfile = base[0] + 'bib' 
 
+    if args.jobs < 1:
+        print('Error: number of parallel downloads must be at least 1.')
+        sys.exit(1)
+
     # Issue warning before overwriting .bib file
-    if args.overwrite == True and os.path.exists(bibfile):
+    if args.overwrite == True and os.path.exists(bibfile) and not args.yes:
         ans = input('Warning this will overwrite existing bib file. Do you want to continue? (y/n): ')
         while ans != 'y' and ans != 'n':
             ans = input("Please answer y or n: ")
@@ -200,16 +461,17 @@ def main():
         if ans == 'n':
             sys.exit()
 
-    # Read bibtex from existing .bib file if updating and store in bibRefs
-    bibRefs = {}
+    # Read reference IDs from existing .bib file if updating and store in bibRefs
+    bibRefs = set()
     if not args.overwrite:
         if os.path.exists(bibfile):
-            bibRefs = ReadBibTeX(bibfile)
+            bibRefs = RefsFromBib(bibfile)
         else:
             args.overwrite = True
 
     # Read \cite IDs from .tex file and store in texRefs
-    texRefs = RefsFromTeX(texfile)
+    tex, cites, texStat = ParseTeX(texfile)
+    texRefs = RefsFromTeX(tex, cites)
     print('{} contains {} references.'.format(texfile, len(texRefs)))
 
     # Check for noinspire.bib file and read bibtex
@@ -219,45 +481,56 @@ def main():
         noinspireRefs = {}
 
     # New bibdata stored in writeRefs
-    writeRefs = collections.OrderedDict()
+    writeRefs = {}
     
-    # Loop over references cited in .tex file
-    skip = []
-    texRepl = {}
-    first = True
-    for i, ref in enumerate(texRefs):
+    # Select references to download
+    download = {}
+    for ref in texRefs:
+        identifier = bibentry.IDType(ref)
 
-        # Skip duplicate references with different identifiers
-        if i in skip:
-            continue
-        
         # Don't download data if it already exists in .bib file
         if (not args.overwrite) and ref in bibRefs:
             if args.inspire:
-                if bibentry.inspireRE.match(ref) is not None:
+                if identifier == 'inspire':
                     continue
             elif args.arxiv:
-                if bibentry.arxivRE.match(ref) is not None or bibentry.arxiv_oldRE.match(ref) is not None:
+                if identifier == 'arxiv':
                     continue
             elif args.doi:
-                if bibentry.doiRE.match(ref) is not None:
+                if identifier == 'doi':
                     continue
             else:
                 continue
 
-        if first:
-            print('Downloading data from Inspire...')
-            first = False
-        if args.verbose:
-            print('\t{}'.format(ref))
+        download[ref] = identifier
+
+    # Download bibtex from Inspire
+    inspireRefs = {}
+    if len(download) > 0:
+        print('Downloading data from Inspire...')
+        inspireRefs = DownloadBibTeX(download, args.verbose, args.jobs, args.refresh)
+
+    # Position of each reference in .tex file, for fast lookup
+    texRefIndex = {ref: i for i, ref in enumerate(texRefs)}
 
-        # Download bibtex from Inspire
-        bibtex = GetInspireBibTeX(ref)
+    # Loop over references cited in .tex file
+    skip = set()
+    texRepl = {}
+    for i, ref in enumerate(texRefs):
+
+        # Skip duplicate references with different identifiers
+        if i in skip:
+            continue
+
+        # Skip references that were not downloaded
+        if ref not in inspireRefs:
+            continue
+
+        bib = inspireRefs[ref]
 
         # Select identifier to use
-        if bibtex is not None:
+        if bib is not None:
 
-            bib = bibentry.BibEntry(bibtex)
             ids = bib.IDs
 
             # Use inspire ID
@@ -275,10 +548,10 @@ def main():
             # Use existing identifier
             # If multiple are used preference is Inspire > arXiv > DOI
             else:
-                if ids['inspire'] in texRefs:
+                if ids['inspire'] in texRefIndex:
                     tag = ids['inspire']
 
-                elif ids['arxiv'] in texRefs:
+                elif ids['arxiv'] in texRefIndex:
                     tag = ids['arxiv']
 
                 else:
@@ -287,21 +560,21 @@ def main():
             # Update dictionary of replacements for .tex file
             # to avoid duplicate bibliography entries
             if tag == ids['inspire']:
-                if ids['arxiv'] in texRefs:
+                if ids['arxiv'] in texRefIndex:
                     texRepl[ids['arxiv']] = ids['inspire']
-                if ids['doi'] in texRefs:
+                if ids['doi'] in texRefIndex:
                     texRepl[ids['doi']] = ids['inspire']
 
             elif tag == ids['arxiv']:
-                if ids['inspire'] in texRefs:
+                if ids['inspire'] in texRefIndex:
                     texRepl[ids['inspire']] = ids['arxiv']
-                if ids['doi'] in texRefs:
+                if ids['doi'] in texRefIndex:
                     texRepl[ids['doi']] = ids['arxiv']
 
             elif tag == ids['doi']:
-                if ids['arxiv'] in texRefs:
+                if ids['arxiv'] in texRefIndex:
                     texRepl[ids['arxiv']] = ids['doi']
-                if ids['inspire'] in texRefs:
+                if ids['inspire'] in texRefIndex:
                     texRepl[ids['inspire']] = ids['doi']
 
             # Add bibtex to output dictionary
@@ -312,10 +585,9 @@ def main():
             # Skip duplicate references with different identifiers
             for id in ids.values():
                 if id is not None and id != ref:
-                    try:
-                        skip.append(texRefs.index(id))
-                    except:
-                        ValueError
+                    j = texRefIndex.get(id)
+                    if j is not None:
+                        skip.add(j)
 
         # If reference can't be found on Inspire check noinspire.bib references
         else:
@@ -329,6 +601,11 @@ def main():
 
     # Write bib file
     if len(writeRefs) > 0:
+
+        # Parse any remaining noinspire.bib entries before the file is
+        # opened, so an invalid entry can't leave it truncated
+        bibtex = '\n'.join(bib.BibTeXString() for bib in writeRefs.values()) + '\n'
+
         print('{} references added to .bib file.'.format(len(writeRefs)))
         if args.overwrite:
             mode = 'w'
@@ -336,8 +613,7 @@ def main():
             mode = 'a'
 
         with open(bibfile, mode) as f:
-            for bib in writeRefs.values():
-                f.write(bib.BibTeXString() + '\n')
+            f.write(bibtex)
     else:
         print('No new references to add.')
 
@@ -351,18 +627,20 @@ def main():
             else:
                 ID_type = 'DOIs'
             print("\nYou have selected to replace all identifiers with {}.".format(ID_type))
-            ans = input('Are you sure you want to update the \cite commands in the tex file? (y/n): ')
+            question = 'Are you sure you want to update the \cite commands in the tex file? (y/n): '
         else:
             print('\nTeX file contains identical references with different identifiers.')
-            ans = input('Do you want to update the \cite commands in the tex file? (order of preference is Inspire > arXiv > DOI) (y/n): ')
-        
-        while ans != 'y' and ans != 'n':
-            ans = input("Please answer y or n: ")
-        
-        if ans == 'n':
-            sys.exit()  
+            question = 'Do you want to update the \cite commands in the tex file? (order of preference is Inspire > arXiv > DOI) (y/n): '
+
+        if not args.yes:
+            ans = input(question)
+            while ans != 'y' and ans != 'n':
+                ans = input("Please answer y or n: ")
+
+            if ans == 'n':
+                sys.exit()
 
-        UpdateTeXCite(texfile, texRepl)
+        UpdateTeXCite(texfile, tex, cites, texStat, texRepl)
 
 ##################################################
 